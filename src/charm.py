@@ -3,8 +3,13 @@
 # See LICENSE file for licensing details.
 """Dispatch logic for the azure CPI operator charm."""
 
+import json
 import logging
+import time
+from functools import cached_property
+from hashlib import blake2b
 from pathlib import Path
+from typing import Any, Dict
 
 import ops
 from ops.interface_azure.requires import AzureIntegrationRequires
@@ -23,6 +28,32 @@ class AzureCloudProviderCharm(ops.CharmBase):
     """Dispatch logic for the AzureCloudProvider charm."""
 
     CA_CERT_PATH = Path("/srv/kubernetes/ca.crt")
+    # at most one readiness query per window when update-status runs more often than 5m
+    READY_CACHE_SECONDS = 300
+    # (event, handler) pairs, registered in order on every dispatch
+    OBSERVERS = (
+        ("kube_control_relation_created", "_kube_control"),
+        ("kube_control_relation_joined", "_kube_control"),
+        ("kube_control_relation_changed", "_cluster_tag"),
+        ("kube_control_relation_broken", "_merge_config"),
+        ("certificates_relation_created", "_merge_config"),
+        ("certificates_relation_changed", "_merge_config"),
+        ("certificates_relation_broken", "_merge_config"),
+        ("external_cloud_provider_relation_joined", "_merge_config"),
+        ("external_cloud_provider_relation_broken", "_merge_config"),
+        ("azure_integration_relation_joined", "_request_azure_features"),
+        ("azure_integration_relation_changed", "_merge_config"),
+        ("azure_integration_relation_broken", "_merge_config"),
+        ("list_versions_action", "_list_versions"),
+        ("list_resources_action", "_list_resources"),
+        ("scrub_resources_action", "_scrub_resources"),
+        ("sync_resources_action", "_sync_resources"),
+        ("update_status", "_update_status"),
+        ("install", "_install_or_upgrade"),
+        ("upgrade_charm", "_install_or_upgrade"),
+        ("config_changed", "_merge_config"),
+        ("stop", "_cleanup"),
+    )
 
     stored = ops.StoredState()
 
@@ -41,8 +72,18 @@ class AzureCloudProviderCharm(ops.CharmBase):
             cluster_tag=None,  # passing along to the integrator from the kube-control relation
             config_hash=None,  # hashed value of the provider config once valid
             deployed=False,  # True if the config has been applied after new hash
+            input_fingerprint=None,  # fingerprint of the charm inputs last deployed
+            last_ready_hash=None,  # config_hash of the deployment last seen Ready
+            last_ready_ts=0.0,  # time when the deployment was last seen Ready
         )
-        self.collector = Collector(
+
+        for event_name, handler_name in self.OBSERVERS:
+            self.framework.observe(getattr(self.on, event_name), getattr(self, handler_name))
+
+    @cached_property
+    def collector(self) -> Collector:
+        """Lazy evaluation of the manifests collector."""
+        return Collector(
             AzureProviderManifests(
                 self,
                 self.charm_config,
@@ -57,35 +98,6 @@ class AzureCloudProviderCharm(ops.CharmBase):
             ),
         )
 
-        self.framework.observe(self.on.kube_control_relation_created, self._kube_control)
-        self.framework.observe(self.on.kube_control_relation_joined, self._kube_control)
-        self.framework.observe(self.on.kube_control_relation_changed, self._cluster_tag)
-        self.framework.observe(self.on.kube_control_relation_broken, self._merge_config)
-
-        self.framework.observe(self.on.certificates_relation_created, self._merge_config)
-        self.framework.observe(self.on.certificates_relation_changed, self._merge_config)
-        self.framework.observe(self.on.certificates_relation_broken, self._merge_config)
-
-        self.framework.observe(self.on.external_cloud_provider_relation_joined, self._merge_config)
-        self.framework.observe(self.on.external_cloud_provider_relation_broken, self._merge_config)
-
-        self.framework.observe(
-            self.on.azure_integration_relation_joined, self._request_azure_features
-        )
-        self.framework.observe(self.on.azure_integration_relation_changed, self._merge_config)
-        self.framework.observe(self.on.azure_integration_relation_broken, self._merge_config)
-
-        self.framework.observe(self.on.list_versions_action, self._list_versions)
-        self.framework.observe(self.on.list_resources_action, self._list_resources)
-        self.framework.observe(self.on.scrub_resources_action, self._scrub_resources)
-        self.framework.observe(self.on.sync_resources_action, self._sync_resources)
-        self.framework.observe(self.on.update_status, self._update_status)
-
-        self.framework.observe(self.on.install, self._install_or_upgrade)
-        self.framework.observe(self.on.upgrade_charm, self._install_or_upgrade)
-        self.framework.observe(self.on.config_changed, self._merge_config)
-        self.framework.observe(self.on.stop, self._cleanup)
-
     def _list_versions(self, event):
         self.collector.list_versions(event)
 
@@ -112,13 +124,24 @@ class AzureCloudProviderCharm(ops.CharmBase):
         if not self.stored.deployed:
             return
 
+        ready_age = time.time() - self.stored.last_ready_ts
+        if (
+            self.stored.last_ready_hash == self.stored.config_hash
+            and 0 <= ready_age < self.READY_CACHE_SECONDS
+        ):
+            self.unit.status = ops.ActiveStatus("Ready")
+            return
+
         unready = self.collector.unready
         if unready:
             self.unit.status = ops.WaitingStatus(", ".join(unready))
+            self.stored.last_ready_hash = None
         else:
             self.unit.status = ops.ActiveStatus("Ready")
             self.unit.set_workload_version(self.collector.short_version)
             self.app.status = ops.ActiveStatus(self.collector.long_version)
+            self.stored.last_ready_hash = self.stored.config_hash
+            self.stored.last_ready_ts = time.time()
 
     def _kube_control(self, event):
         self.kube_control.set_auth_request(self.unit.name, "system:masters")
@@ -192,7 +215,36 @@ class AzureCloudProviderCharm(ops.CharmBase):
             return False
         return True
 
+    def _invalidate_manifest_config(self):
+        if "collector" not in self.__dict__:
+            return  # no manifests config has been cached yet
+        for controller in self.collector.manifests.values():
+            controller.invalidate_config()
+
+    def _input_fingerprint(self) -> str:
+        """Fingerprint the charm config and the remote data of every relation."""
+        inputs: Dict[str, Any] = {"config": dict(self.config)}
+        for name in self.meta.relations:
+            for relation in self.model.relations[name]:
+                data = {unit.name: dict(relation.data[unit]) for unit in relation.units}
+                if relation.app:
+                    data[relation.app.name] = dict(relation.data[relation.app])
+                inputs[f"{name}:{relation.id}"] = data
+        payload = json.dumps(inputs, sort_keys=True, separators=(",", ":"), default=str)
+        return blake2b(payload.encode("utf-8"), digest_size=8).hexdigest()
+
     def _merge_config(self, event):
+        fingerprint = self._input_fingerprint()
+        if (
+            self.stored.deployed
+            and self.stored.input_fingerprint == fingerprint
+            and not isinstance(event, ops.RelationBrokenEvent)
+        ):
+            log.info("Skipping reconcile, charm inputs are unchanged.")
+            return
+        self.stored.input_fingerprint = None
+
+        self._invalidate_manifest_config()
         if not self._check_azure_relation(event):
             return
 
@@ -218,6 +270,7 @@ class AzureCloudProviderCharm(ops.CharmBase):
         if self._install_or_upgrade(event, config_hash=new_hash):
             self.stored.config_hash = new_hash
             self.stored.deployed = True
+            self.stored.input_fingerprint = fingerprint
 
     def _install_or_upgrade(self, event, config_hash=None):
         if self.stored.config_hash == config_hash:
@@ -226,6 +279,7 @@ class AzureCloudProviderCharm(ops.CharmBase):
 
         self.unit.status = ops.MaintenanceStatus("Deploying Azure Cloud Provider")
         self.unit.set_workload_version("")
+        self.stored.last_ready_hash = None  # readiness must be re-checked after applying
         for controller in self.collector.manifests.values():
             try:
                 controller.apply_manifests()
@@ -239,6 +293,7 @@ class AzureCloudProviderCharm(ops.CharmBase):
     def _cleanup(self, event):
         if self.stored.config_hash:
             self.unit.status = ops.MaintenanceStatus("Cleaning up Azure Cloud Provider")
+            self.stored.last_ready_hash = None
             for controller in self.collector.manifests.values():
                 try:
                     controller.delete_manifests(ignore_unauthorized=True)
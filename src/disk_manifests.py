@@ -4,14 +4,12 @@
 import base64
 import json
 import logging
-import pickle
-from hashlib import md5
-from typing import Dict, List, Optional
+from functools import cached_property, partial
+from typing import Any, Dict, List, Optional
 
 import humps
 from lightkube.codecs import AnyResource, from_dict
-from lightkube.models.core_v1 import Toleration, TopologySpreadConstraint
-from lightkube.models.meta_v1 import LabelSelector
+from lightkube.models.core_v1 import Toleration
 from ops.interface_azure.requires import AzureIntegrationRequires
 from ops.manifests import (
     Addition,
@@ -22,8 +20,34 @@ from ops.manifests import (
     update_tolerations,
 )
 
-log = logging.getLogger(__file__)
+from manifest_utils import config_hash, topology_spread
+
+log = logging.getLogger(__name__)
 STORAGE_CLASS_NAME = "csi-azure-{type}"
+CONTROL_PLANE_KEYS = frozenset(
+    {
+        "node-role.kubernetes.io/control-plane",
+        "node-role.kubernetes.io/master",  # wokeignore:rule=master
+    }
+)
+AZURE_JSON_DEFAULTS: Dict[str, Any] = dict(  # static portion of the disk cloud-config
+    cloud="AzurePublicCloud",
+    cloudProviderBackoff=True,
+    cloudProviderBackoffRetries=6,
+    cloudProviderBackoffExponent=1.5,
+    cloudProviderBackoffDuration=5,
+    cloudProviderBackoffJitter=1,
+    cloudProviderRatelimit=True,
+    cloudProviderRateLimitQPS=6,
+    cloudProviderRateLimitBucket=20,
+    useManagedIdentityExtension=False,
+    userAssignedIdentityID="",
+    useInstanceMetadata=True,
+    excludeMasterFromStandardLB=False,
+    maximumLoadBalancerRuleCount=250,
+    enableMultipleStandardLoadBalancers=False,
+    tags="a=b,c=d",
+)
 
 
 class WriteSecret(Addition):
@@ -33,57 +57,46 @@ class WriteSecret(Addition):
     https://github.com/kubernetes-sigs/azuredisk-csi-driver/blob/master/docs/read-from-secret.md
     """
 
-    REQUIRED = {
-        "aad-client-id",
-        "aad-client-secret",
-        "resource-group",
-        "location",
-        "subnet-name",
-        "security-group-name",
-        "subscription-id",
-        "tenant-id",
-        "vnet-name",
-        "vnet-resource-group",
-    }
-    OPTIONAL = {
-        "load-balancer-sku",
-        "primary-availability-set-name",
-        "primary-scale-set-name",
-        "route-table-name",
-        "vm-type",
-    }
+    REQUIRED = frozenset(
+        {
+            "aad-client-id",
+            "aad-client-secret",
+            "resource-group",
+            "location",
+            "subnet-name",
+            "security-group-name",
+            "subscription-id",
+            "tenant-id",
+            "vnet-name",
+            "vnet-resource-group",
+        }
+    )
+    OPTIONAL = frozenset(
+        {
+            "load-balancer-sku",
+            "primary-availability-set-name",
+            "primary-scale-set-name",
+            "route-table-name",
+            "vm-type",
+        }
+    )
+    CAMEL_KEYS = {k: humps.camelize(k) for k in REQUIRED | OPTIONAL}
 
     def __call__(self) -> Optional[AnyResource]:
         """Create Secret for Azure secret Deployments and Daemonsets."""
-        if any(s is self.manifests.config.get(s) for s in self.REQUIRED):
+        config = self.manifests.config
+        if any(config.get(k) is None for k in self.REQUIRED):
             log.error("azuredisk: Secret Data unavailable")
             return None
 
         log.info("Applying azuredisk secret data")
-        azure_json = dict(
-            cloud="AzurePublicCloud",
-            cloudProviderBackoff=True,
-            cloudProviderBackoffRetries=6,
-            cloudProviderBackoffExponent=1.5,
-            cloudProviderBackoffDuration=5,
-            cloudProviderBackoffJitter=1,
-            cloudProviderRatelimit=True,
-            cloudProviderRateLimitQPS=6,
-            cloudProviderRateLimitBucket=20,
-            useManagedIdentityExtension=False,
-            userAssignedIdentityID="",
-            useInstanceMetadata=True,
-            excludeMasterFromStandardLB=False,
-            maximumLoadBalancerRuleCount=250,
-            enableMultipleStandardLoadBalancers=False,
-            tags="a=b,c=d",
-        )
-        required = {k: v for k, v in self.manifests.config.items() if k in self.REQUIRED}
-        optional = {k: v for k, v in self.manifests.config.items() if k in self.OPTIONAL and v}
-        azure_json.update(**humps.camelize(required))  # updated required
-        for key in self.OPTIONAL:  # remove optional keys
-            azure_json.pop(humps.camelize(key), None)
-        azure_json.update(**humps.camelize(optional))  # set any available optional keys
+        required = {self.CAMEL_KEYS[k]: v for k, v in config.items() if k in self.REQUIRED}
+        optional = {self.CAMEL_KEYS[k]: v for k, v in config.items() if k in self.OPTIONAL and v}
+        azure_json = {
+            **AZURE_JSON_DEFAULTS,
+            **required,  # updated required
+            **optional,  # set any available optional keys
+        }
 
         base64_json = base64.b64encode(json.dumps(azure_json).encode()).decode()
         secret = dict(
@@ -100,13 +113,12 @@ class UpdateNode(Patch):
     """Update the node daemonset as a patch."""
 
     NAME = "csi-azuredisk-node"
-    REQUIRED = {
-        "control-node-selector",
-    }
+    MATCH = ("DaemonSet", NAME)
+    REQUIRED = frozenset({"control-node-selector"})
 
     def __call__(self, obj):
         """Update the DaemonSet object in the cloud-node-manager."""
-        if not (obj.kind == "DaemonSet" and obj.metadata.name == self.NAME):
+        if (obj.kind, obj.metadata.name) != self.MATCH:
             return
         node_selector = self.manifests.config.get("control-node-selector")
         if not isinstance(node_selector, dict):
@@ -120,33 +132,34 @@ class UpdateController(Patch):
     """Update the disk controller Deployment as a patch."""
 
     NAME = "csi-azuredisk-controller"
-    REQUIRED = {
-        "control-node-selector",
-    }
-
-    def _adjuster(self, tolerations: List[Toleration]) -> List[Toleration]:
-        node_selector = self.manifests.config.get("control-node-selector", {})
-        for t in tolerations:
-            if "control-plane" in t.key:
-                return [
-                    Toleration(
-                        key=key,
-                        value=value,
-                        effect=t.effect,
-                        operator="Equal",
-                        tolerationSeconds=t.tolerationSeconds,
-                    )
-                    for key, value in node_selector.items()
-                ]
-        return []
+    REQUIRED = frozenset({"control-node-selector"})
+
+    def _adjuster(
+        self, node_selector: Dict[str, str], tolerations: List[Toleration]
+    ) -> List[Toleration]:
+        match = next((t for t in tolerations if t.key in CONTROL_PLANE_KEYS), None)
+        if not match:
+            return []
+        return [
+            Toleration(
+                key=key,
+                value=value,
+                effect=match.effect,
+                operator="Equal",
+                tolerationSeconds=match.tolerationSeconds,
+            )
+            for key, value in node_selector.items()
+        ]
 
 
 class UpdateControllerDeployment(UpdateController):
     """Update the Deployment object to reference juju supplied node selector."""
 
+    MATCH = ("Deployment", UpdateController.NAME)
+
     def __call__(self, obj):
         """Update the Deployment object in the deployment."""
-        if not (obj.kind == "Deployment" and obj.metadata.name == self.NAME):
+        if (obj.kind, obj.metadata.name) != self.MATCH:
             return
         node_selector = self.manifests.config.get("control-node-selector")
         if not isinstance(node_selector, dict):
@@ -154,7 +167,7 @@ class UpdateControllerDeployment(UpdateController):
                 f"azuredisk control-node-selector was an unexpected type: {type(node_selector)}"
             )
             return
-        obj.spec.template.spec.nodeSelector = node_selector
+        obj.spec.template.spec.nodeSelector = dict(node_selector)  # not the cached config dict
         node_selector_text = " ".join('{0}: "{1}"'.format(*t) for t in node_selector.items())
         log.info(f"Applying azuredisk control node selector as {node_selector_text}")
 
@@ -163,16 +176,11 @@ class UpdateControllerDeployment(UpdateController):
             log.info(f"Replacing azuredisk default replicas of {obj.spec.replicas} to {replicas}")
             obj.spec.replicas = replicas
 
-        update_tolerations(obj, self._adjuster)
+        update_tolerations(obj, partial(self._adjuster, node_selector))
         log.info("Adding azuredisk topologySpreadConstraints")
 
         obj.spec.template.spec.topologySpreadConstraints = [
-            TopologySpreadConstraint(
-                maxSkew=1,
-                topologyKey="kubernetes.io/hostname",
-                whenUnsatisfiable="DoNotSchedule",
-                labelSelector=LabelSelector(matchLabels=dict(**obj.spec.selector.matchLabels)),
-            )
+            topology_spread(obj.spec.selector.matchLabels)
         ]
 
 
@@ -208,6 +216,9 @@ class CreateStorageClass(Addition):
         )
 
 
+REQUIRED_CONFIG = WriteSecret.REQUIRED | UpdateControllerDeployment.REQUIRED | UpdateNode.REQUIRED
+
+
 class AzureDiskManifests(Manifests):
     """Deployment Specific details for the cs-azuredisk-driver."""
 
@@ -225,9 +236,12 @@ class AzureDiskManifests(Manifests):
         self.integrator: AzureIntegrationRequires = integrator
         self.kube_control = kube_control
 
-    @property
+    @cached_property
     def config(self) -> Dict:
-        """Returns current config available from charm config and joined relations."""
+        """Returns current config available from charm config and joined relations.
+
+        Memoized until the charm invalidates it at the start of the next reconcile.
+        """
         config = {}
         if self.integrator.is_ready:
             config.update(
@@ -252,24 +266,23 @@ class AzureDiskManifests(Manifests):
             config["replicas"] = len(self.kube_control.relation.units)
 
         config.update(**self.charm_config.available_data)
-
-        for key, value in dict(**config).items():
-            if value == "" or value is None:
-                del config[key]
+        config = {key: value for key, value in config.items() if value not in ("", None)}
 
         config["release"] = config.pop("azuredisk-release", None)
 
         return config
 
+    def invalidate_config(self) -> None:
+        """Drop the memoized config so the next access re-reads the charm inputs."""
+        self.__dict__.pop("config", None)
+
     def hash(self) -> int:
         """Calculate a hash of the current configuration."""
-        return int(md5(pickle.dumps(self.config)).hexdigest(), 16)
+        return config_hash(self.config)
 
     def evaluate(self) -> Optional[str]:
         """Determine if manifest_config can be applied to manifests."""
-        props = WriteSecret.REQUIRED | UpdateControllerDeployment.REQUIRED | UpdateNode.REQUIRED
-        for prop in props:
-            value = self.config.get(prop)
-            if not value:
-                return f"AzureDisk manifests waiting for definition of {prop}"
+        missing = REQUIRED_CONFIG - {key for key, value in self.config.items() if value}
+        if missing:
+            return f"AzureDisk manifests waiting for definition of {min(missing)}"
         return None
@@ -0,0 +1,28 @@
+# Copyright 2026 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Helpers shared by the azure provider and disk manifests."""
+import json
+from hashlib import blake2b
+from typing import Any, Dict
+
+from lightkube.models.core_v1 import TopologySpreadConstraint
+from lightkube.models.meta_v1 import LabelSelector
+
+TOPOLOGY_SPREAD: Dict[str, Any] = dict(
+    maxSkew=1,
+    topologyKey="kubernetes.io/hostname",
+    whenUnsatisfiable="DoNotSchedule",
+)
+
+
+def config_hash(config: Dict[str, Any]) -> int:
+    """Calculate a stable 64-bit hash of a manifests config."""
+    payload = json.dumps(config, sort_keys=True, separators=(",", ":"), default=str)
+    return int.from_bytes(blake2b(payload.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def topology_spread(match_labels: Dict[str, str]) -> TopologySpreadConstraint:
+    """Spread pods matching the labels across distinct hosts."""
+    return TopologySpreadConstraint(
+        labelSelector=LabelSelector(matchLabels=match_labels.copy()), **TOPOLOGY_SPREAD
+    )
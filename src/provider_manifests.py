@@ -3,61 +3,68 @@
 """Implementation of azure cloud provider specific details of the kubernetes manifests."""
 import json
 import logging
-import pickle
-from hashlib import md5
+from functools import cached_property
 from typing import Dict, Optional
 
 import humps
-from lightkube.models.core_v1 import Toleration, TopologySpreadConstraint
-from lightkube.models.meta_v1 import LabelSelector
+from lightkube.models.core_v1 import Toleration
 from ops.interface_azure.requires import AzureIntegrationRequires
 from ops.manifests import ConfigRegistry, ManifestLabel, Manifests, Patch
 
-log = logging.getLogger(__file__)
+from manifest_utils import config_hash, topology_spread
+
+log = logging.getLogger(__name__)
 SECRET_NAME = "azure-cloud-config"
 
 
 class UpdateSecret(Patch):
     """Update the secret as a patch since the manifests includes a default."""
 
-    REQUIRED = {
-        "aad-client-id",
-        "aad-client-secret",
-        "resource-group",
-        "location",
-        "subnet-name",
-        "security-group-name",
-        "subscription-id",
-        "tenant-id",
-        "vnet-name",
-        "vnet-resource-group",
-    }
-    OPTIONAL = {
-        "load-balancer-sku",
-        "primary-availability-set-name",
-        "primary-scale-set-name",
-        "route-table-name",
-        "vm-type",
-    }
+    MATCH = ("Secret", SECRET_NAME)
+    REQUIRED = frozenset(
+        {
+            "aad-client-id",
+            "aad-client-secret",
+            "resource-group",
+            "location",
+            "subnet-name",
+            "security-group-name",
+            "subscription-id",
+            "tenant-id",
+            "vnet-name",
+            "vnet-resource-group",
+        }
+    )
+    OPTIONAL = frozenset(
+        {
+            "load-balancer-sku",
+            "primary-availability-set-name",
+            "primary-scale-set-name",
+            "route-table-name",
+            "vm-type",
+        }
+    )
+    CAMEL_KEYS = {k: humps.camelize(k) for k in REQUIRED | OPTIONAL}
 
     def __call__(self, obj):
         """Update the secrets object in the deployment."""
-        if not (obj.kind == "Secret" and obj.metadata.name == SECRET_NAME):
+        if (obj.kind, obj.metadata.name) != self.MATCH:
             return
 
-        if any(s is self.manifests.config.get(s) for s in self.REQUIRED):
+        config = self.manifests.config
+        if any(config.get(k) is None for k in self.REQUIRED):
             log.error("secret data item is None")
             return
 
         log.info("Applying provider secret data")
         azure_json = json.loads(obj.stringData["azure.json"])
-        required = {k: v for k, v in self.manifests.config.items() if k in self.REQUIRED}
-        optional = {k: v for k, v in self.manifests.config.items() if k in self.OPTIONAL and v}
+        required = {self.CAMEL_KEYS[k]: v for k, v in config.items() if k in self.REQUIRED}
+        optional = {self.CAMEL_KEYS[k]: v for k, v in config.items() if k in self.OPTIONAL and v}
 
-        azure_json.update(**humps.camelize(required))  # updated required
+        azure_json.update(**required)  # updated required
         for key in self.OPTIONAL:  # remove optional keys
-            azure_json.pop(humps.camelize(key), None)
-        azure_json.update(**humps.camelize(optional))  # set any available optional keys
+            azure_json.pop(self.CAMEL_KEYS[key], None)
+        azure_json.update(**optional)  # set any available optional keys
         obj.stringData["azure.json"] = json.dumps(azure_json)
 
 
@@ -65,23 +72,21 @@ class UpdateNode(Patch):
     """Update the node manager daemonset as a patch."""
 
     NAME = "cloud-node-manager"
+    MATCH = ("DaemonSet", NAME)
 
     def __call__(self, obj):
         """Update the DaemonSet object in the cloud-node-manager."""
-        if not (obj.kind == "DaemonSet" and obj.metadata.name == self.NAME):
+        if (obj.kind, obj.metadata.name) != self.MATCH:
             return
 
         current_keys = {toleration.key for toleration in obj.spec.template.spec.tolerations}
         missing_tolerations = [
-            Toleration(
-                key=taint.key,
-                value=taint.value,
-                effect=taint.effect,
-            )
-            for taint in self.manifests.config.get("control-node-taints", [])
-            if taint.key not in current_keys
+            Toleration(key=key, value=value, effect=effect)
+            for key, value, effect in self.manifests.config.get("control-node-tolerations", ())
+            if key not in current_keys
         ]
-        obj.spec.template.spec.tolerations += missing_tolerations
+        if missing_tolerations:
+            obj.spec.template.spec.tolerations += missing_tolerations
         log.info("Adding provider tolerations from control-plane")
 
         container = next(
@@ -97,19 +102,23 @@ class UpdateController(Patch):
     """Update the cloud controller Deployment/Pod as a patch."""
 
     NAME = "cloud-controller-manager"
-    REQUIRED = {
-        "control-node-selector",
-    }
-    OPTIONAL = {
-        "cluster-cidr",
-        "route-reconciliation-period",
-    }
+    REQUIRED = frozenset({"control-node-selector"})
+    OPTIONAL = frozenset(
+        {
+            "cluster-cidr",
+            "route-reconciliation-period",
+        }
+    )
 
     def _update_args(self, spec) -> None:
-        cluster_tag = self.manifests.config.get("cluster-tag")
+        config = self.manifests.config
+        cluster_tag = config.get("cluster-tag")
         container = next(filter(lambda c: c.name == self.NAME, spec.containers), None)
         if container:
-            arguments = dict(arg.split("=") for arg in container.args)
+            arguments: Dict[str, Optional[str]] = {}
+            for arg in container.args:
+                key, sep, value = arg.partition("=")
+                arguments[key] = value if sep else None  # None for bare flags
             arguments["--allocate-node-cidrs"] = "false"
             arguments["--configure-cloud-routes"] = "false"
             for arg in self.OPTIONAL:
@@ -117,28 +126,29 @@ class UpdateController(Patch):
             if cluster_tag:
                 log.info(f"Replacing default cluster-name to {cluster_tag}")
                 arguments["--cluster-name"] = cluster_tag
-            container.args = [f"{key}={value}" for key, value in arguments.items()]
+            args = [key if value is None else f"{key}={value}" for key, value in arguments.items()]
+            if args != container.args:
+                container.args = args
 
         current_keys = {toleration.key for toleration in spec.tolerations}
         missing_tolerations = [
-            Toleration(
-                key=taint.key,
-                value=taint.value,
-                effect=taint.effect,
-            )
-            for taint in self.manifests.config.get("control-node-taints", [])
-            if taint.key not in current_keys
+            Toleration(key=key, value=value, effect=effect)
+            for key, value, effect in config.get("control-node-tolerations", ())
+            if key not in current_keys
         ]
-        spec.tolerations += missing_tolerations
+        if missing_tolerations:
+            spec.tolerations += missing_tolerations
         log.info("Adding provider tolerations from control-plane")
 
 
 class UpdateControllerPod(UpdateController):
     """Update the Pod object to reference juju supplied node selector."""
 
+    MATCH = ("Pod", UpdateController.NAME)
+
     def __call__(self, obj):
         """Update the Deployment object in the deployment."""
-        if not (obj.kind == "Pod" and obj.metadata.name == self.NAME):
+        if (obj.kind, obj.metadata.name) != self.MATCH:
             return
 
         self._update_args(obj.spec)
@@ -147,21 +157,24 @@ class UpdateControllerPod(UpdateController):
 class UpdateControllerDeployment(UpdateController):
     """Update the Deployment object to reference juju supplied node selector."""
 
+    MATCH = ("Deployment", UpdateController.NAME)
+
     def __call__(self, obj):
         """Update the Deployment object in the deployment."""
-        if not (obj.kind == "Deployment" and obj.metadata.name == self.NAME):
+        if (obj.kind, obj.metadata.name) != self.MATCH:
             return
-        node_selector = self.manifests.config.get("control-node-selector")
+        config = self.manifests.config
+        node_selector = config.get("control-node-selector")
         if not isinstance(node_selector, dict):
             log.error(
                 f"provider control-node-selector was an unexpected type: {type(node_selector)}"
             )
             return
-        obj.spec.template.spec.nodeSelector = node_selector
+        obj.spec.template.spec.nodeSelector = dict(node_selector)  # not the cached config dict
         node_selector_text = " ".join('{0}: "{1}"'.format(*t) for t in node_selector.items())
         log.info(f"Applying provider Control Node Selector as {node_selector_text}")
 
-        replicas = self.manifests.config.get("replicas")
+        replicas = config.get("replicas")
         if replicas and obj.spec.replicas != replicas:
             log.info(f"Replacing default replicas of {obj.spec.replicas} to {replicas}")
             obj.spec.replicas = replicas
@@ -171,16 +184,14 @@ class UpdateControllerDeployment(UpdateController):
         log.info("Adding provider topologySpreadConstraints")
 
         obj.spec.template.spec.topologySpreadConstraints = [
-            TopologySpreadConstraint(
-                maxSkew=1,
-                topologyKey="kubernetes.io/hostname",
-                whenUnsatisfiable="DoNotSchedule",
-                labelSelector=LabelSelector(matchLabels=dict(**obj.spec.selector.matchLabels)),
-            )
+            topology_spread(obj.spec.selector.matchLabels)
         ]
         self._update_args(obj.spec.template.spec)
 
 
+REQUIRED_CONFIG = UpdateSecret.REQUIRED | UpdateControllerDeployment.REQUIRED
+
+
 class AzureProviderManifests(Manifests):
     """Deployment Specific details for the azure-cloud-provider."""
 
@@ -200,9 +211,12 @@ class AzureProviderManifests(Manifests):
         self.integrator: AzureIntegrationRequires = integrator
         self.kube_control = kube_control
 
-    @property
+    @cached_property
     def config(self) -> Dict:
-        """Returns current config available from charm config and joined relations."""
+        """Returns current config available from charm config and joined relations.
+
+        Memoized until the charm invalidates it at the start of the next reconcile.
+        """
         config = {}
         if self.integrator.is_ready:
             config.update(
@@ -222,33 +236,35 @@ class AzureProviderManifests(Manifests):
         if self.kube_control.is_ready:
             config["image-registry"] = self.kube_control.get_registry_location()
             config["cluster-tag"] = self.kube_control.get_cluster_tag()
-            config["control-node-taints"] = self.kube_control.get_controller_taints() or [
+            taints = self.kube_control.get_controller_taints() or [
                 Toleration("NoSchedule", "node-role.kubernetes.io/control-plane")
             ]  # by default
+            config["control-node-tolerations"] = tuple(
+                (taint.key, taint.value, taint.effect) for taint in taints
+            )  # each patch builds its own Toleration models from these
             config["control-node-selector"] = {
                 label.key: label.value for label in self.kube_control.get_controller_labels()
             } or {"juju-application": self.kube_control.relation.app.name}
             config["replicas"] = len(self.kube_control.relation.units)
 
         config.update(**self.charm_config.available_data)
-
-        for key, value in dict(**config).items():
-            if value == "" or value is None:
-                del config[key]
+        config = {key: value for key, value in config.items() if value not in ("", None)}
 
         config["release"] = config.pop("provider-release", None)
 
         return config
 
+    def invalidate_config(self) -> None:
+        """Drop the memoized config so the next access re-reads the charm inputs."""
+        self.__dict__.pop("config", None)
+
     def hash(self) -> int:
         """Calculate a hash of the current configuration."""
-        return int(md5(pickle.dumps(self.config)).hexdigest(), 16)
+        return config_hash(self.config)
 
     def evaluate(self) -> Optional[str]:
         """Determine if manifest_config can be applied to manifests."""
-        props = UpdateSecret.REQUIRED | UpdateControllerDeployment.REQUIRED
-        for prop in props:
-            value = self.config.get(prop)
-            if not value:
-                return f"Provider manifests waiting for definition of {prop}"
+        missing = REQUIRED_CONFIG - {key for key, value in self.config.items() if value}
+        if missing:
+            return f"Provider manifests waiting for definition of {min(missing)}"
         return None
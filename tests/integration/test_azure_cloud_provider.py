@@ -180,21 +180,20 @@ async def test_create_service_loadbalancer(kubernetes: AsyncClient, loadbalanced
     res, name, namespace = type(_svc), _svc.metadata.name, _svc.metadata.namespace
 
     async def get_and_check():
+        delay = 0.5
         while True:
             service = await kubernetes.get(res, name, namespace=namespace)
             if not service.status.loadBalancer.ingress:
                 log.info("Loadbalancer service not yet ready.")
-                await asyncio.sleep(5)
-                continue
-
-            (svc_ip,) = map(lambda ingress: ingress.ip, service.status.loadBalancer.ingress)
-            try:
-                ipaddress.ip_address(svc_ip)
-                break
-            except ValueError:
-                log.info(f"Loadbalancer service ip wasn't an IP address {svc_ip}.")
-                pass
-            await asyncio.sleep(5)
+            else:
+                svc_ip = service.status.loadBalancer.ingress[0].ip
+                try:
+                    ipaddress.ip_address(svc_ip)
+                    break
+                except ValueError:
+                    log.info(f"Loadbalancer service ip wasn't an IP address {svc_ip}.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5)
 
     # confirm loadbalancer goes active
     try:
@@ -3,6 +3,8 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import logging
+import time
 import unittest.mock as mock
 from pathlib import Path
 
@@ -11,13 +13,27 @@ import ops.testing
 import pytest
 import yaml
 from lightkube import ApiError
-from lightkube.core.internal_resources import apiextensions
+from lightkube.resources import core_v1
+from ops.charm import RelationBrokenEvent
+from ops.interface_kube_control import KubeControlRequirer
+from ops.interface_tls_certificates import CertificatesRequires
 from ops.manifests import ManifestClientError
-from ops.model import BlockedStatus, MaintenanceStatus, WaitingStatus
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
 
 from charm import AzureCloudProviderCharm
 
 ops.testing.SIMULATE_CAN_CONNECT = True
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)  # libyaml when available
+
+
+@pytest.fixture(scope="session")
+def certificates_data():
+    return yaml.load(Path("tests/data/certificates_data.yaml").read_text(), Loader=YAML_LOADER)
+
+
+@pytest.fixture(scope="session")
+def kube_control_data():
+    return yaml.load(Path("tests/data/kube_control_data.yaml").read_text(), Loader=YAML_LOADER)
 
 
 @pytest.fixture
@@ -30,12 +46,24 @@ def harness():
 
 
 @pytest.fixture(autouse=True)
-def mock_ca_cert(tmpdir):
-    ca_cert = Path(tmpdir) / "ca.crt"
+def mock_ca_cert(tmp_path):
+    ca_cert = tmp_path / "ca.crt"
     with mock.patch.object(AzureCloudProviderCharm, "CA_CERT_PATH", ca_cert):
         yield ca_cert
 
 
+@pytest.fixture()
+def uncached_relations(monkeypatch):
+    # re-read relation data on every access as the harness updates it mid-test
+    uncached = {
+        CertificatesRequires: ("relation", "_data", "_raw_data"),
+        KubeControlRequirer: ("relation", "_data"),
+    }
+    for rel_cls, names in uncached.items():
+        for name in names:
+            monkeypatch.setattr(rel_cls, name, property(getattr(rel_cls, name).func))
+
+
 @pytest.fixture()
 def control_plane(harness):
     rel_id = harness.add_relation("external-cloud-provider", "kubernetes-control-plane")
@@ -43,45 +71,55 @@ def control_plane(harness):
     harness.add_relation_unit(rel_id, "kubernetes-control-plane/1")
 
 
+INTEGRATOR_ATTRS = {
+    "tenant_id": "0000000-0000-0000-0000-000000000000",
+    "aad_client_id": "0000000-0000-0000-0000-000000000000",
+    "aad_client_secret": "0000000-0000-0000-0000-000000000000",
+    "subscription_id": "0000000-0000-0000-0000-000000000000",
+    "resource_group": "name",
+    "resource_group_location": "eastus",
+    "subnet_name": "subnet",
+    "security_group_name": "subnet-group",
+    "vnet_name": "vnet-name",
+    "vnet_resource_group": "vnet-resource-group",
+    "evaluate_relation.return_value": None,
+}
+CERTIFICATES_ATTRS = {
+    "ca": "abcd",
+    "evaluate_relation.return_value": None,
+}
+KUBE_CONTROL_ATTRS = {
+    "evaluate_relation.return_value": None,
+    "get_registry_location.return_value": "rocks.canonical.com/cdk",
+    "get_cluster_tag.return_value": "kubernetes-thing",
+    "get_controller_taints.return_value": [],
+    "get_controller_labels.return_value": [],
+    "relation.app.name": "kubernetes-control-plane",
+    "relation.units": [f"kubernetes-control-plane/{_}" for _ in range(2)],
+}
+
+
+def _mock_requires(monkeypatch, target, attrs):
+    # a fresh mock per test, so call records and child mocks never leak between tests
+    mocked = mock.MagicMock()
+    mocked.return_value.configure_mock(**attrs)
+    monkeypatch.setattr(target, mocked)
+    return mocked.return_value
+
+
 @pytest.fixture()
-def integrator():
-    with mock.patch("charm.AzureIntegrationRequires") as mocked:
-        integrator = mocked.return_value
-        integrator.tenant_id = "0000000-0000-0000-0000-000000000000"
-        integrator.aad_client_id = "0000000-0000-0000-0000-000000000000"
-        integrator.aad_client_secret = "0000000-0000-0000-0000-000000000000"
-        integrator.subscription_id = "0000000-0000-0000-0000-000000000000"
-        integrator.resource_group = "name"
-        integrator.resource_group_location = "eastus"
-        integrator.subnet_name = "subnet"
-        integrator.security_group_name = "subnet-group"
-        integrator.vnet_name = "vnet-name"
-        integrator.vnet_resource_group = "vnet-resource-group"
-        integrator.evaluate_relation.return_value = None
-        yield integrator
+def integrator(monkeypatch):
+    return _mock_requires(monkeypatch, "charm.AzureIntegrationRequires", INTEGRATOR_ATTRS)
 
 
 @pytest.fixture()
-def certificates():
-    with mock.patch("charm.CertificatesRequires") as mocked:
-        certificates = mocked.return_value
-        certificates.ca = "abcd"
-        certificates.evaluate_relation.return_value = None
-        yield certificates
+def certificates(monkeypatch):
+    return _mock_requires(monkeypatch, "charm.CertificatesRequires", CERTIFICATES_ATTRS)
 
 
 @pytest.fixture()
-def kube_control():
-    with mock.patch("charm.KubeControlRequirer") as mocked:
-        kube_control = mocked.return_value
-        kube_control.evaluate_relation.return_value = None
-        kube_control.get_registry_location.return_value = "rocks.canonical.com/cdk"
-        kube_control.get_cluster_tag.return_value = "kubernetes-thing"
-        kube_control.get_controller_taints.return_value = []
-        kube_control.get_controller_labels.return_value = []
-        kube_control.relation.app.name = "kubernetes-control-plane"
-        kube_control.relation.units = [f"kubernetes-control-plane/{_}" for _ in range(2)]
-        yield kube_control
+def kube_control(monkeypatch):
+    return _mock_requires(monkeypatch, "charm.KubeControlRequirer", KUBE_CONTROL_ATTRS)
 
 
 def test_waits_for_integrator(harness):
@@ -91,18 +129,14 @@ def test_waits_for_integrator(harness):
     assert charm.unit.status.message == "Missing required azure-integration"
 
 
-@pytest.mark.usefixtures("integrator")
-def test_waits_for_certificates(harness):
+@pytest.mark.usefixtures("integrator", "uncached_relations")
+def test_waits_for_certificates(harness, certificates_data):
     harness.begin_with_initial_hooks()
     charm = harness.charm
     assert isinstance(charm.unit.status, BlockedStatus)
     assert charm.unit.status.message == "Missing required certificates"
 
     # Test adding the certificates relation
-    rel_cls = type(charm.certificates)
-    rel_cls.relation = property(rel_cls.relation.func)
-    rel_cls._data = property(rel_cls._data.func)
-    rel_cls._raw_data = property(rel_cls._raw_data.func)
     rel_id = harness.add_relation("certificates", "easyrsa")
     assert isinstance(charm.unit.status, WaitingStatus)
     assert charm.unit.status.message == "Waiting for certificates"
@@ -112,24 +146,21 @@ def test_waits_for_certificates(harness):
     harness.update_relation_data(
         rel_id,
         "easyrsa/0",
-        yaml.safe_load(Path("tests/data/certificates_data.yaml").read_text()),
+        certificates_data,
     )
     assert isinstance(charm.unit.status, BlockedStatus)
     assert charm.unit.status.message == "Missing required kube-control relation"
 
 
 @mock.patch("ops.interface_kube_control.KubeControlRequirer.create_kubeconfig")
-@pytest.mark.usefixtures("integrator", "certificates")
-def test_waits_for_kube_control(mock_create_kubeconfig, harness):
+@pytest.mark.usefixtures("integrator", "certificates", "uncached_relations")
+def test_waits_for_kube_control(mock_create_kubeconfig, harness, kube_control_data):
     harness.begin_with_initial_hooks()
     charm = harness.charm
     assert isinstance(charm.unit.status, BlockedStatus)
     assert charm.unit.status.message == "Missing required kube-control relation"
 
     # Add the kube-control relation
-    rel_cls = type(charm.kube_control)
-    rel_cls.relation = property(rel_cls.relation.func)
-    rel_cls._data = property(rel_cls._data.func)
     rel_id = harness.add_relation("kube-control", "kubernetes-control-plane")
     assert isinstance(charm.unit.status, WaitingStatus)
     assert charm.unit.status.message == "Waiting for kube-control relation"
@@ -142,7 +173,7 @@ def test_waits_for_kube_control(mock_create_kubeconfig, harness):
     harness.update_relation_data(
         rel_id,
         "kubernetes-control-plane/0",
-        yaml.safe_load(Path("tests/data/kube_control_data.yaml").read_text()),
+        kube_control_data,
     )
     mock_create_kubeconfig.assert_has_calls(
         [
@@ -154,62 +185,146 @@ def test_waits_for_kube_control(mock_create_kubeconfig, harness):
     assert charm.unit.status.message == "Deploying Azure Cloud Provider"
 
 
-@pytest.mark.usefixtures("integrator", "certificates", "kube_control", "control_plane")
-def test_waits_for_config(harness, lk_client, caplog):
+@pytest.fixture()
+def primed_harness(harness, integrator, certificates, kube_control, control_plane):
     harness.begin_with_initial_hooks()
+    return harness
 
+
+@pytest.fixture()
+def config_harness(lk_client, primed_harness):
     lk_client.list.return_value = [mock.Mock(**{"metadata.annotations": {}})]
-    caplog.clear()
-    harness.update_config(
-        {
-            "control-node-selector": "azure.io/my-control-node=",
-        }
-    )
-    provider_messages = {r.message for r in caplog.records if "provider" in r.filename}
-
-    assert provider_messages == {
-        "Adding provider tolerations from control-plane",
-        "Adding provider topologySpreadConstraints",
-        'Applying provider Control Node Selector as azure.io/my-control-node: ""',
-        "Replacing default cluster-name to kubernetes-thing",
-        "Replacing default replicas of 1 to 2",
-        "Applying provider secret data",
-        "Setting wait-routes=false",
-    }
+    return primed_harness
+
+
+CUSTOM_SELECTOR = {"control-node-selector": "azure.io/my-control-node="}
+DEFAULT_SELECTOR = {"control-node-selector": "", "image-registry": "dockerhub.io"}
+DEFAULT_SELECTOR_MESSAGES = {
+    "Adding provider tolerations from control-plane",
+    "Adding provider topologySpreadConstraints",
+    'Applying provider Control Node Selector as juju-application: "kubernetes-control-plane"',
+    "Replacing default replicas of 1 to 2",
+    "Replacing default cluster-name to kubernetes-thing",
+    "Applying provider secret data",
+    "Setting wait-routes=false",
+}
+
+
+@pytest.mark.parametrize(
+    "configs,expected",
+    [
+        pytest.param(
+            [CUSTOM_SELECTOR],
+            {
+                "Adding provider tolerations from control-plane",
+                "Adding provider topologySpreadConstraints",
+                'Applying provider Control Node Selector as azure.io/my-control-node: ""',
+                "Replacing default cluster-name to kubernetes-thing",
+                "Replacing default replicas of 1 to 2",
+                "Applying provider secret data",
+                "Setting wait-routes=false",
+            },
+            id="Node selector",
+        ),
+        pytest.param(
+            [DEFAULT_SELECTOR],
+            DEFAULT_SELECTOR_MESSAGES,
+            id="Default node selector",
+        ),
+        pytest.param(
+            [CUSTOM_SELECTOR, DEFAULT_SELECTOR],
+            DEFAULT_SELECTOR_MESSAGES,
+            id="Custom reverted to default node selector",
+        ),
+    ],
+)
+def test_waits_for_config(config_harness, caplog, configs, expected):
+    caplog.set_level(logging.INFO, logger="provider_manifests")
+    for config in configs:  # applied in order on one charm, only the last is asserted
+        caplog.clear()
+        config_harness.update_config(config)
+    provider_messages = {r.message for r in caplog.records if r.name == "provider_manifests"}
+    assert provider_messages == expected
+
+
+def test_merge_config_skips_unchanged_inputs(primed_harness):
+    charm = primed_harness.charm
+    assert charm.stored.deployed
+    with mock.patch.object(charm, "_install_or_upgrade") as mock_install:
+        charm._merge_config(mock.MagicMock())
+    mock_install.assert_not_called()
+
+
+def test_merge_config_reconciles_relation_broken(primed_harness):
+    charm = primed_harness.charm
+    assert charm.stored.input_fingerprint
+    with mock.patch.object(charm, "_install_or_upgrade") as mock_install:
+        charm._merge_config(mock.MagicMock(spec=RelationBrokenEvent))
+    mock_install.assert_called_once()
+
+
+def test_merge_config_reconciles_after_blocked_run(primed_harness):
+    charm = primed_harness.charm
+    with mock.patch.object(charm, "_check_config", return_value=False):
+        primed_harness.update_config({"image-registry": "dockerhub.io"})
+    assert charm.stored.deployed
+
+    # back to the inputs last deployed, the blocked run must not let this skip
+    with mock.patch.object(charm, "_install_or_upgrade") as mock_install:
+        primed_harness.update_config({"image-registry": "mcr.microsoft.com"})
+    mock_install.assert_called_once()
 
-    caplog.clear()
-    harness.update_config(
-        {
-            "control-node-selector": "",
-            "image-registry": "dockerhub.io",
-        }
-    )
-    provider_messages = {r.message for r in caplog.records if "provider" in r.filename}
-
-    assert provider_messages == {
-        "Adding provider tolerations from control-plane",
-        "Adding provider topologySpreadConstraints",
-        'Applying provider Control Node Selector as juju-application: "kubernetes-control-plane"',
-        "Replacing default replicas of 1 to 2",
-        "Replacing default cluster-name to kubernetes-thing",
-        "Applying provider secret data",
-        "Setting wait-routes=false",
-    }
+
+def test_update_status_trusts_recent_ready(harness):
+    harness.begin()
+    charm = harness.charm
+    charm.stored.deployed = True
+    charm.stored.config_hash = charm.stored.last_ready_hash = 1234
+    charm.stored.last_ready_ts = time.time()
+    with mock.patch.object(
+        type(charm), "collector", new_callable=mock.PropertyMock
+    ) as mock_collector:
+        charm._update_status(None)
+    mock_collector.assert_not_called()
+    assert charm.unit.status == ActiveStatus("Ready")
+
+
+def _is_core_v1(obj_type) -> bool:
+    # only core group kinds can be loaded from the bare "v1" apiVersion
+    return obj_type.__module__ == core_v1.__name__
+
+
+def test_upgrade_resets_ready_cache(primed_harness):
+    charm = primed_harness.charm
+    charm.stored.last_ready_hash = charm.stored.config_hash
+    charm.stored.last_ready_ts = time.time()
+    charm.on.upgrade_charm.emit()
+    assert charm.stored.last_ready_hash is None
+
+    primed_harness.set_leader(True)  # update-status sets the app status
+    with mock.patch.object(
+        type(charm), "collector", new_callable=mock.PropertyMock
+    ) as mock_collector:
+        mock_collector.return_value.configure_mock(
+            unready=[], short_version="v1.28.0", long_version="Versions: v1.28.0"
+        )
+        charm._update_status(None)
+    mock_collector.assert_called()
+    assert charm.stored.last_ready_hash == charm.stored.config_hash
 
 
 @pytest.fixture()
 def mock_get_response(lk_client, api_error_klass):
     def client_get_response(obj_type, name, *, namespace=None, labels=None):
-        try:
-            return codecs.from_dict(
-                dict(
-                    apiVersion="v1",
-                    kind=obj_type.__name__,
-                    metadata=dict(name=name, namespace=namespace, labels=labels),
-                )
-            )
-        except AttributeError:
+        if not _is_core_v1(obj_type):
             raise api_error_klass()
+        return codecs.from_dict(
+            dict(
+                apiVersion="v1",
+                kind=obj_type.__name__,
+                metadata=dict(name=name, namespace=namespace, labels=labels),
+            )
+        )
 
     with mock.patch.object(lk_client, "get", side_effect=client_get_response):
         yield client_get_response
@@ -218,28 +333,20 @@ def mock_get_response(lk_client, api_error_klass):
 @pytest.fixture()
 def mock_list_response(lk_client, mock_get_response):
     def client_list_response(obj_type, *, namespace=None, labels=None):
-        if obj_type == apiextensions.CustomResourceDefinition:
-            return []
-
-        try:
-            return [
-                mock_get_response(obj_type, name="MockThing", namespace=namespace, labels=labels)
-            ]
-        except ApiError:
+        if not _is_core_v1(obj_type):  # includes CustomResourceDefinition
             return []
+        return [mock_get_response(obj_type, name="MockThing", namespace=namespace, labels=labels)]
 
     with mock.patch.object(lk_client, "list", side_effect=client_list_response):
         yield client_list_response
 
 
-@pytest.mark.usefixtures("integrator", "certificates", "kube_control", "control_plane")
 @pytest.mark.usefixtures("mock_list_response")
-def test_action_list_resources(harness, caplog):
-    harness.begin_with_initial_hooks()
+def test_action_list_resources(primed_harness, caplog):
     event = mock.MagicMock()
     event.params = {}
-    with mock.patch.object(harness.charm.collector, "list_resources") as mock_list:
-        harness.charm._list_resources(event)
+    with mock.patch.object(primed_harness.charm.collector, "list_resources") as mock_list:
+        primed_harness.charm._list_resources(event)
     mock_list.assert_called_with(event, "", "")
 
 
@@ -261,19 +368,17 @@ def test_action_scrub_resources(harness):
     mock_scrub.assert_called_with(event, "cloud-provider-azure", "Secret")
 
 
-@pytest.mark.usefixtures("integrator", "certificates", "kube_control", "control_plane")
-def test_action_sync_resources(harness, lk_client, mock_get_response, caplog):
+def test_action_sync_resources(lk_client, mock_get_response, primed_harness, caplog):
     class MockApiError(ApiError):
         def __init__(self):
             pass
 
-    harness.begin_with_initial_hooks()
     event = mock.MagicMock()
     event.params = {"resources": "Secret", "controller": "cloud-provider-azure"}
     with mock.patch.object(lk_client, "list", return_value=[]):
         with mock.patch.object(lk_client, "get", side_effect=MockApiError):
             with mock.patch.object(lk_client, "apply") as mock_apply:
-                harness.charm._sync_resources(event)
+                primed_harness.charm._sync_resources(event)
     args, kwargs = mock_apply.call_args
     (resource,) = args
     assert all(